@@ -1,11 +1,25 @@
 import enum
+import itertools
 import json
 import os
-import openai
-from tiktoken import Tokenizer
-from zara_personality import primer as zara_primer
+from dataclasses import dataclass, field
+from typing import Callable
 
-openai.api_key = os.getenv("openai")
+# openai, tiktoken and the personality primer are imported on first use to keep importing this module cheap
+_openai_initialized = False
+
+
+def _import_openai():
+    """
+    Imports the OpenAI client and sets its API key the first time it's needed.
+    """
+    global _openai_initialized
+    import openai
+
+    if not _openai_initialized:
+        openai.api_key = os.getenv("openai")
+        _openai_initialized = True
+    return openai
 
 
 class Model(enum.Enum):
@@ -23,6 +37,35 @@ Model_Token_Limit = {
     Model.GPT4_LARGE: 32000,
 }
 
+# Punctuation a complete response is expected to end with
+_SENTENCE_END = (".", "!", "?")
+
+# Minimum number of available tokens needed to bother asking for a continuation of an unfinished response
+MIN_CONTINUATION_TOKENS = 32
+
+# Bound once to skip the attribute lookup when parsing function call arguments
+_loads = json.loads
+
+
+@dataclass
+class _TokenAccount:
+    """
+    Token bookkeeping for a conversation history.
+
+    Instance variables:
+        primer_tokens: The number of tokens in the initial messages.
+        live_tokens: The number of tokens in the messages after the initial messages.
+        message_tokens: The token count of each message, in the same order as the conversation history.
+    """
+
+    primer_tokens: int = 0
+    live_tokens: int = 0
+    message_tokens: list[int] = field(default_factory=list)
+
+    @property
+    def total(self):
+        return self.primer_tokens + self.live_tokens
+
 
 class OpenAIChatbot2:
     model: Model = Model.GPT3_LARGE
@@ -31,16 +74,16 @@ class OpenAIChatbot2:
 
     primers: list[dict[str, str]]
     functions: list[dict]
-    functions_callable: dict[str, function]
+    functions_callable: dict[str, Callable]
 
     # This is a list of messages that are not primers
     conversation: list[dict[str, str]]
 
     def __init__(
         self,
-        primers: list[dict[str, str]] = zara_primer,
+        primers: list[dict[str, str]] = None,
         functions: list[dict] = [],
-        functions_callable: dict[str, function] = [],
+        functions_callable: dict[str, Callable] = [],
         conversation: list[dict[str, str]] = [],
         model: Model = Model.GPT3_LARGE,
         max_response_tokens: int = None,
@@ -49,6 +92,9 @@ class OpenAIChatbot2:
         self.model = model
         self.max_response_tokens = max_response_tokens
 
+        if primers is None:
+            from zara_personality import primer as primers
+
         self.primers = primers
         self.functions = functions
         self.functions_callable = functions_callable
@@ -105,6 +151,8 @@ class OpenAIChatbot2:
         """
         Counts the total number of tokens in a list of messages.
         """
+        from tiktoken import Tokenizer
+
         tokenizer = Tokenizer()
 
         # Count the tokens in each message's content (and name if it's a function) and sum them.
@@ -134,7 +182,8 @@ class OpenAIChatbot:
     Instance variables:
         model: The name of the model to use.
         initial_messages: The list of initial messages used to prime the chatbot - will always be the first messages in the conversation history.
-        conversation_history: The list of messages in the conversation history.
+        conversation_history: The list of messages in the conversation history. Only change it through the chatbot's methods,
+            otherwise the token counts used for trimming will be wrong.
         max_token_size: The maximum number of tokens allowed in the conversation history.
         trim_message_callback: A callback function that is called when a message (or messages) is trimmed from the conversation history.
 
@@ -142,12 +191,12 @@ class OpenAIChatbot:
 
     def __init__(
         self,
-        personality_primer: list[dict[str, str]] = zara_primer,
+        personality_primer: list[dict[str, str]] = None,
         use_large_model=False,
         initial_messages: list[dict[str, str]] = None,
         messages: list[dict[str, str]] = None,
         functions: list[dict[str, str]] = None,
-        functions_callable: list[dict[str, function]] = None,
+        functions_callable: dict[str, Callable] = None,
         max_token_size=None,
         trim_message_callback=None,
         error_callback=None,
@@ -157,12 +206,12 @@ class OpenAIChatbot:
         Creates a new OpenAIChatbot instance.
 
         Args:
-            personality_primer: A list of messages to use as the personality primer, in the same format as OpenAI completion API messages. ([{"role": ..., "content": ...}, ...}])
+            personality_primer: A list of messages to use as the personality primer, in the same format as OpenAI completion API messages. ([{"role": ..., "content": ...}, ...}]) - defaults to the Zara primer.
             use_large_model: Whether to use the large model (gpt-3.5-turbo-16k) or the small model (gpt-3.5-turbo) - defaults to False.
             initial_messages: A list of messages to use as the initial messages along with the personality primer - defaults to None.
             messages: A list of messages to start the conversation with - defaults to None.
             functions: A list of function descriptions to be passed to the chatbot - defaults to None.
-            functions_callable: A list of actual functions corresponding to the function descriptions (Must use the same names as in 'functions') - defaults to None.
+            functions_callable: A dict mapping function names to the actual functions corresponding to the function descriptions (Must use the same names as in 'functions') - defaults to None.
             max_token_size: The maximum number of tokens allowed in the conversation history - defaults to 16000 if use_large_model is True, otherwise 4000.
             trim_message_callback: A callback function that is called when a message (or messages) is trimmed from the conversation history - defaults to None.
             response_token_size: The number of tokens to use for the assistant's response - defaults to the API's default value.
@@ -174,28 +223,51 @@ class OpenAIChatbot:
         self.trim_message_callback = trim_message_callback
         self.response_token_size = response_token_size
 
+        # Tokenizer (expensive to construct, so we only create it once)
+        from tiktoken import Tokenizer
+
+        self._tokenizer = Tokenizer()
+
         # Functions
         self.functions = functions
-        self.functions_callable = functions_callable
+        # Normalize to a single name -> function dict, flattening a list of dicts if one was passed
+        if isinstance(functions_callable, list):
+            functions_callable = {
+                name: func for d in functions_callable for name, func in d.items()
+            }
+        self.functions_callable = functions_callable or {}
+
+        # Personality primer (copied so extending it doesn't mutate the caller's list or the shared default)
+        if personality_primer is None:
+            from zara_personality import primer as personality_primer
 
-        # Personality primer
-        self.initial_messages = personality_primer
+        self.initial_messages = list(personality_primer)
 
         if initial_messages:
             self.initial_messages.extend(initial_messages)
 
+        # The primer never changes after this point, so its token count only needs to be computed once
+        # (all of its contents are tokenized together in one batch call)
+        primer_contents = [message["content"] for message in self.initial_messages]
+        primer_counts = [
+            len(ids) for ids in self._tokenizer.encode_batch(primer_contents)
+        ]
+        self._tokens = _TokenAccount(
+            primer_tokens=sum(primer_counts), message_tokens=primer_counts
+        )
+
         # Conversation history
         self.conversation_history = self.initial_messages.copy()
 
         # Add messages to the conversation history
         if messages:
-            self.conversation_history.extend(messages)
+            self._extend_msgs(self._to_messages(messages))
 
     def create_response(self):
         """
         Wrapper function for the OpenAI completion API to avoid boilerplate code.
         """
-        return openai.ChatCompletion.create(
+        return _import_openai().ChatCompletion.create(
             model=self.model,
             messages=self.conversation_history,
             functions=self.functions,
@@ -212,8 +284,75 @@ class OpenAIChatbot:
         Returns:
             The total number of tokens in the list of messages.
         """
-        tokenizer = Tokenizer()
-        return sum(tokenizer.count_tokens(message["content"]) for message in messages)
+        # The conversation history is already accounted for
+        if messages is self.conversation_history:
+            return self._tokens.total
+
+        return sum(
+            self._tokenizer.count_tokens(message["content"]) for message in messages
+        )
+
+    # All changes to conversation_history go through _append_msg, _extend_msgs and _pop_msg,
+    # which keep self._tokens in step with it
+    def _append_msg(self, message: dict[str, str]):
+        """
+        Appends a message to the conversation history and adds its tokens to the account.
+        """
+        count = self._tokenizer.count_tokens(message["content"])
+        self._tokens.message_tokens.append(count)
+        self._tokens.live_tokens += count
+        self.conversation_history.append(message)
+
+    def _to_messages(self, messages: list):
+        """
+        Converts caller-supplied messages into new message dicts for the conversation history.
+
+        Strings become user messages and dicts are copied, so trimming never rewrites the caller's dicts.
+
+        Raises:
+            ValueError: If a message dict has no "content" key.
+        """
+        new_messages = []
+        for message in messages:
+            if isinstance(message, str):
+                new_messages.append({"role": "user", "content": message})
+            elif "content" in message:
+                new_messages.append(dict(message))
+            else:
+                raise ValueError("Messages must have a 'content' key.")
+        return new_messages
+
+    def _extend_msgs(self, messages: list[dict[str, str]]):
+        """
+        Appends several messages to the conversation history, tokenizing them all in a single batch call.
+        """
+        counts = [
+            len(ids)
+            for ids in self._tokenizer.encode_batch(
+                [message["content"] for message in messages]
+            )
+        ]
+        self._tokens.message_tokens.extend(counts)
+        self._tokens.live_tokens += sum(counts)
+        self.conversation_history.extend(messages)
+
+    def _pop_msg(self, index: int = -1):
+        """
+        Removes a message from the conversation history and removes its tokens from the account.
+
+        Returns:
+            The removed message.
+        """
+        if index < 0:
+            index += len(self.conversation_history)
+
+        message = self.conversation_history.pop(index)
+        count = self._tokens.message_tokens.pop(index)
+        if index < len(self.initial_messages):
+            self._tokens.primer_tokens -= count
+        else:
+            self._tokens.live_tokens -= count
+        return message
 
     def update_conversation_history(self, message_content: str, role="user", name=None):
         """
@@ -226,6 +365,10 @@ class OpenAIChatbot:
         Returns:
             The number of tokens available in the conversation history after the update.
         """
+        # Bind these once, they're used repeatedly below (including in the trim loop)
+        primer_len = len(self.initial_messages)
+        response_size = self.response_token_size
+
         if message_content is not None:
             # Check if function, if so, add name
             if role == "function":
@@ -233,26 +376,24 @@ class OpenAIChatbot:
             else:
                 new_message = {"role": role, "content": message_content}
 
-            self.conversation_history.append(new_message)
-
-        tokenizer = Tokenizer()
+            self._append_msg(new_message)
 
         # Check the total tokens used so far
-        total_tokens = self.count_tokens(self.conversation_history)
-        available_tokens = self.max_token_size - total_tokens
+        available_tokens = self.max_token_size - self.count_tokens(
+            self.conversation_history
+        )
 
         callback_invoked = False
 
         # When we have more than one user message in the history (excluding the initial messages)
-        if len(self.conversation_history) > len(self.initial_messages) + 1:
-            while available_tokens < self.response_token_size:
+        if len(self.conversation_history) > primer_len + 1:
+            while available_tokens < response_size:
                 # We remove the oldest user message after the initial messages
-                if len(self.conversation_history) > len(self.initial_messages) + 1:
-                    self.conversation_history.pop(
-                        len(self.initial_messages) + 1
+                if len(self.conversation_history) > primer_len + 1:
+                    self._pop_msg(
+                        primer_len + 1
                     )  # Remove the oldest conversation message after initial messages
-                    total_tokens = self.count_tokens(self.conversation_history)
-                    available_tokens = self.max_token_size - total_tokens
+                    available_tokens = self.max_token_size - self._tokens.total
 
                     # If the callback hasn't been invoked yet, invoke it
                     if not callback_invoked and self.trim_message_callback:
@@ -268,26 +409,31 @@ class OpenAIChatbot:
 
         # If there's only one user message and it's too long
         elif (
-            len(self.conversation_history) == len(self.initial_messages) + 1
-            and available_tokens < self.response_token_size
+            len(self.conversation_history) == primer_len + 1
+            and available_tokens < response_size
         ):
-            user_message = self.conversation_history[-1]["content"]
-            text_tokens = list(tokenizer.tokenize(user_message))
-            available_tokens_for_message = available_tokens - self.response_token_size
+            last_message = self.conversation_history[-1]
+            token_ids = self._tokenizer.encode(last_message["content"])
+
+            # The message has to shrink by however many tokens we're short for the response
+            available_tokens_for_message = max(
+                0, len(token_ids) - (response_size - available_tokens)
+            )
 
-            if len(text_tokens) > available_tokens_for_message:
+            if len(token_ids) > available_tokens_for_message:
                 # Trim the message
-                user_message = "".join(
-                    [
-                        token.string
-                        for token in text_tokens[:available_tokens_for_message]
-                    ]
-                )
-                self.conversation_history[-1][
-                    "content"
-                ] = user_message  # Replace the message with the trimmed message
+                token_ids = token_ids[:available_tokens_for_message]
+
+                # Replace the message with the trimmed message
+                last_message["content"] = self._tokenizer.decode(token_ids)
+
+                # Count the decoded text, it can re-encode to a different length than the slice
+                count = self._tokenizer.count_tokens(last_message["content"])
+                message_tokens = self._tokens.message_tokens
+                self._tokens.live_tokens += count - message_tokens[-1]
+                message_tokens[-1] = count
                 available_tokens = (
-                    self.response_token_size
+                    self.max_token_size - self._tokens.total
                 )  # Now we have just enough tokens for the assistant's response
 
                 if self.trim_message_callback:
@@ -310,7 +456,7 @@ class OpenAIChatbot:
         if response_message.get("function_call"):
             func = response_message.get("function_call")
             func_name = func.get("name")
-            func_args = json.loads(func.get("arguments"))
+            func_args = _loads(func.get("arguments"))
 
             # Check if the function exists
             if func_name in self.functions_callable:
@@ -349,10 +495,11 @@ class OpenAIChatbot:
         reply = response.choices[0].message.get("content")
 
         # If the response does not end with punctuation, we give it one more shot to finish
-        if reply[-1] not in {".", "!", "?"}:
+        if not reply.endswith(_SENTENCE_END):
             available_tokens = self.update_conversation_history(reply, "assistant")
 
-            if available_tokens > 0:
+            # Skip the extra API call if there's no room left for a useful continuation
+            if available_tokens >= MIN_CONTINUATION_TOKENS:
                 continuation_response = self.create_response()
 
                 continuation_reply = continuation_response.choices[0].message.get(
@@ -366,14 +513,27 @@ class OpenAIChatbot:
         """
         Removes the last message from the conversation history.
         """
-        self.conversation_history.pop()
+        self._pop_msg()
 
     def add_messages(self, messages: list):
         """
-        Adds a list of messages to the conversation history.
+        Adds a list of messages to the conversation history, then trims the history once if necessary.
+
+        Args:
+            messages: A list of messages, either as message dicts or as user message strings.
+
+        Returns:
+            The number of tokens available in the conversation history after the update.
+
+        Raises:
+            ValueError: If a message dict has no "content" key.
         """
-        for message in messages:
-            self.update_conversation_history(message)
+        new_messages = self._to_messages(messages)
+        if new_messages:
+            self._extend_msgs(new_messages)
+
+        # Trim once for the whole batch
+        return self.update_conversation_history(None)
 
     def respond(self, user_message):
         """
@@ -394,3 +554,9 @@ class OpenAIChatbot:
     # Get conversation history, minus the initial messages
     def get_conversation(self):
         return self.conversation_history[len(self.initial_messages) :]
+
+    # Iterate over the conversation history, minus the initial messages, without copying it
+    def iter_conversation(self):
+        return itertools.islice(
+            self.conversation_history, len(self.initial_messages), None
+        )
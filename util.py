@@ -3,6 +3,11 @@ import json
 import random
 import time
 
+# The timezone name and daylight savings flag don't change while the process is running
+_DAYLIGHT = bool(time.daylight)
+_TZNAME = time.tzname[1] if _DAYLIGHT else time.tzname[0]
+_TZNAME_JSON = json.dumps(_TZNAME)
+
 
 def get_time_info():
     """
@@ -19,12 +24,10 @@ def get_time_info():
         ```
     """
     current_time = datetime.datetime.now()
-    time_info = {}
-    time_info["time"] = current_time.isoformat()
-    time_info["timezone"] = time.tzname[0] if not time.daylight else time.tzname[1]
-    time_info["is_dst"] = time.daylight and time.localtime().tm_isdst > 0
+    is_dst = _DAYLIGHT and time.localtime().tm_isdst > 0
 
-    return json.dumps(time_info)
+    # Build the JSON directly, the timezone name is already escaped
+    return f'{{"time": "{current_time.isoformat()}", "timezone": {_TZNAME_JSON}, "is_dst": {"true" if is_dst else "false"}}}'
 
 
 def roll_dice(
@@ -59,5 +62,6 @@ def roll_dice(
     return {"result": roll_result + modifier, "rolls": rolls}
 
 
-# Usage:
-print(roll_dice(advantage=True))
+if __name__ == "__main__":
+    # Usage:
+    print(roll_dice(advantage=True))